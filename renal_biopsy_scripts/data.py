@@ -2,8 +2,10 @@ import os
 from pathlib import Path
 
 import h5py
+import hdf5plugin
+import numba
 import numpy as np
-from scipy.spatial.distance import cdist
+from joblib import Parallel, delayed
 from tqdm import tqdm
 import openslide
 import typer
@@ -12,6 +14,164 @@ __all__ = ["PatchPairs"]
 
 app = typer.Typer()
 
+def _near_pairs(coords: np.ndarray, threshold_sq: float) -> np.ndarray:
+    """
+    All (i, j) with squared distance in (0, threshold_sq), in np.argwhere order.
+
+    Points are hashed into a grid of cells as wide as the threshold, so a
+    point is only compared against points in its own and the 8 neighbouring
+    cells. Every step is vectorised over the points.
+    """
+    if len(coords) == 0 or threshold_sq <= 0:
+        return np.empty((0, 2), dtype=np.int64)
+
+    grid = np.floor(coords / np.sqrt(threshold_sq)).astype(np.int64)
+    # shift cells to start at 1 so neighbour keys never wrap into another column
+    grid -= grid.min(axis=0) - 1
+    height = grid[:, 1].max() + 2
+    keys = grid[:, 0] * height + grid[:, 1]
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    points = np.arange(len(coords))
+    pairs = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbor_keys = keys + dx * height + dy
+            lo = np.searchsorted(sorted_keys, neighbor_keys, side='left')
+            counts = np.searchsorted(sorted_keys, neighbor_keys, side='right') - lo
+            # position of every candidate inside its neighbouring cell
+            within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            i = np.repeat(points, counts)
+            j = order[np.repeat(lo, counts) + within]
+            offsets = coords[i] - coords[j]
+            lengths_sq = np.einsum('ij,ij->i', offsets, offsets)
+            keep = (lengths_sq < threshold_sq) & (lengths_sq > 0)
+            pairs.append(np.stack((i[keep], j[keep]), axis=1))
+
+    pairs = np.concatenate(pairs)
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+@numba.njit(parallel=True, cache=True)
+def _count_far_pairs(coords, threshold_sq, counts):
+    n = coords.shape[0]
+    for i in numba.prange(n):
+        count = 0
+        for j in range(n):
+            dx = coords[i, 0] - coords[j, 0]
+            dy = coords[i, 1] - coords[j, 1]
+            if dx * dx + dy * dy > threshold_sq:
+                count += 1
+        counts[i] = count
+
+@numba.njit(parallel=True, cache=True)
+def _fill_far_pairs(coords, threshold_sq, offsets, pairs, filled):
+    n = coords.shape[0]
+    for i in numba.prange(n):
+        k = offsets[i]
+        end = offsets[i + 1]
+        for j in range(n):
+            if k == end:
+                break
+            dx = coords[i, 0] - coords[j, 0]
+            dy = coords[i, 1] - coords[j, 1]
+            if dx * dx + dy * dy > threshold_sq:
+                pairs[k, 0] = i
+                pairs[k, 1] = j
+                k += 1
+        filled[i] = k
+
+def _far_pairs(coords: np.ndarray, threshold_sq: float) -> np.ndarray:
+    """
+    All (i, j) with squared distance above threshold_sq, in np.argwhere order.
+
+    Distances are computed and thresholded in one fused pass per row, so no
+    distance matrix is ever allocated. A counting pass sizes the output and
+    gives every row its own slice of it, which keeps the parallel fill
+    lock-free and the rows in order. Both passes must agree on every pair
+    (hence no fastmath), which is checked rather than trusted.
+    """
+    counts = np.empty(len(coords), dtype=np.int64)
+    _count_far_pairs(coords, threshold_sq, counts)
+    offsets = np.zeros(len(coords) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    pairs = np.full((offsets[-1], 2), -1, dtype=np.int64)
+    filled = np.empty(len(coords), dtype=np.int64)
+    _fill_far_pairs(coords, threshold_sq, offsets, pairs, filled)
+    assert np.array_equal(filled, offsets[1:]), "far pair count and fill passes disagree"
+    return pairs
+
+def _process_slide(
+    slide_id: str,
+    slides_directory: Path,
+    patches_directory: Path,
+    save_directory: Path,
+    downsample: int,
+    maximim_similar_mm: float,
+    minimum_dissimilar_mm: float,
+    num_similar_per_slide: int,
+    num_dissimilar_per_slide: int,
+    auto_skip: bool,):
+    """
+    Generates and saves the patch pairs for a single slide.
+
+    Runs inside a worker process, so every file is opened here rather than
+    being handed over from the parent.
+    """
+
+    MPP_PROPS = ['openslide.mpp-x', 'openslide.mpp-x']
+    EXT = ".h5"
+    COORDS = 'coords'
+    PAIRS_CHUNK_ROWS = 1024
+
+    save_file = save_directory / (slide_id + EXT)
+    patches_file = patches_directory/(slide_id+EXT)
+
+    if auto_skip and os.path.exists(save_file):
+        return
+
+    slide = openslide.OpenSlide(str(slides_directory/(slide_id+".svs")))
+
+    if MPP_PROPS[0] not in slide.properties:
+        raise Exception("I can't do my job without mpp!")
+
+    microns_per_pixel_lvl0 = [float(slide.properties[i]) for i in MPP_PROPS]
+    millimeters_per_pixel = max([(mpp*downsample)/1000 for mpp in microns_per_pixel_lvl0])
+
+    with h5py.File(patches_file, mode='r') as patches:
+        coords = patches[COORDS][:].astype(np.float64)
+
+    # Work with squared pixel distances against squared mm thresholds, so
+    # neither the mm scaling nor a square root is applied per pair
+    mm_sq_per_px_sq = 2 * millimeters_per_pixel ** 2
+    similar_sq = maximim_similar_mm ** 2 / mm_sq_per_px_sq
+    dissimilar_sq = minimum_dissimilar_mm ** 2 / mm_sq_per_px_sq
+
+    similar = _near_pairs(coords, similar_sq)
+
+    # Most pairs are dissimilar, so these are enumerated without building
+    # the N x N distance matrix
+    dissimilar = _far_pairs(coords, dissimilar_sq)
+
+    if len(similar) < num_similar_per_slide:
+        raise Exception(f"Only found {len(similar)} similar out of {num_similar_per_slide}")
+
+    if len(dissimilar) < num_dissimilar_per_slide:
+        raise Exception(f"Only found {len(dissimilar)} dissimilar out of {num_dissimilar_per_slide}")
+
+    # PatchPairs reads one row at a time, so store small compressed chunks
+    # instead of one contiguous block (unlimited maxshape lets a chunk be
+    # larger than a short dataset)
+    with h5py.File(save_file, mode='w', libver='latest') as f:
+        for label, pairs in (("similar", similar), ("dissimilar", dissimilar)):
+            f.create_dataset(
+                label,
+                data=pairs,
+                chunks=(PAIRS_CHUNK_ROWS, 2),
+                maxshape=(None, 2),
+                **hdf5plugin.Blosc2(cname='zstd', clevel=5, filters=hdf5plugin.Blosc2.SHUFFLE),
+            )
+
 @app.command()
 def generate_patch_pairs(
     slides_directory: Path,
@@ -22,45 +182,29 @@ def generate_patch_pairs(
     minimum_dissimilar_mm: float = 100.,
     num_similar_per_slide: int = 32,
     num_dissimilar_per_slide: int = 32,
-    auto_skip: bool = True,):
-
-    MPP_PROPS = ['openslide.mpp-x', 'openslide.mpp-x']
-    EXT = ".h5"
-    COORDS = 'coords'
+    auto_skip: bool = True,
+    n_jobs: int = -1,):
 
     os.makedirs(save_directory, exist_ok=True)
 
-    for f in tqdm(os.listdir(patches_directory)):
-        slide_id = f.split('.')[0]
-        slide = openslide.OpenSlide(str(slides_directory/(slide_id+".svs")))
-        save_file = save_directory / (slide_id + EXT)
-        patches_file = patches_directory/(slide_id+EXT)
-
-        if auto_skip and os.path.exists(save_file):
-            continue
-
-        if MPP_PROPS[0] not in slide.properties:
-            raise Exception("I can't do my job without mpp!")
-
-        microns_per_pixel_lvl0 = [float(slide.properties[i]) for i in MPP_PROPS]
-        millimeters_per_pixel = max([(mpp*downsample)/1000 for mpp in microns_per_pixel_lvl0])
-
-        patches = h5py.File(patches_file, mode='r')
-        coords = patches[COORDS]
-
-        distances = np.sqrt(2) * millimeters_per_pixel * cdist(coords, coords)
-        similar = np.argwhere((distances < maximim_similar_mm) & (distances > 0) )
-        dissimilar = np.argwhere(distances > minimum_dissimilar_mm)
-        
-        if len(similar) < num_similar_per_slide:
-            raise Exception(f"Only found {len(similar)} similar out of {num_similar_per_slide}")
-
-        if len(dissimilar) < num_dissimilar_per_slide:
-            raise Exception(f"Only found {len(dissimilar)} dissimilar out of {num_dissimilar_per_slide}")
-    
-        with h5py.File(save_file, mode='w') as f:
-            f.create_dataset("similar", data=similar)
-            f.create_dataset("dissimilar", data=dissimilar)
+    # Slides are independent of each other, so spread them over processes
+    with os.scandir(patches_directory) as entries:
+        slide_ids = [os.path.splitext(e.name)[0] for e in entries]
+    Parallel(n_jobs=n_jobs, backend='loky')(
+        delayed(_process_slide)(
+            slide_id,
+            slides_directory,
+            patches_directory,
+            save_directory,
+            downsample,
+            maximim_similar_mm,
+            minimum_dissimilar_mm,
+            num_similar_per_slide,
+            num_dissimilar_per_slide,
+            auto_skip,
+        )
+        for slide_id in tqdm(slide_ids)
+    )
 
 if __name__ == "__main__":
     app()
\ No newline at end of file
@@ -1,67 +1,178 @@
 import os
+import zipfile
 from pathlib import Path
 from typing import Tuple
 
 import h5py
+import hdf5plugin  # registers the Blosc2 filter used by the pair files
+import numpy as np
 from torch.utils.data import Dataset
 import torch
 
+from handles import HandleCache, atomic_write
+
 __all__ = ["PatchPairs"]
 
+def _open_h5(path: Path) -> h5py.File:
+    return h5py.File(path, 'r')
+
 class PatchPairs(Dataset):
+
+    BUCKET_CACHE = "_bucket_cache.npz"
+    # Every slide takes two handles (pairs and patches), so this keeps the
+    # files of the 64 most recently used slides open in each worker
+    MAX_OPEN_FILES = 128
+
     def __init__(
         self,
         patches_directory: Path, 
         pairs_directory: Path,        
     ):
-        slide_ids = [i.split('.')[0] for i in os.listdir(pairs_directory)]
-        buckets_to_slide = {}
-        num_pairs = 0
+        with os.scandir(pairs_directory) as entries:
+            slide_ids = sorted(e.name[:-len(".h5")] for e in entries if e.name.endswith(".h5"))
+        num_similar, num_dissimilar = self._count_pairs(pairs_directory, slide_ids)
+
+        # Per-slide metadata lives in flat arrays, so finding the bucket of an
+        # index is a binary search. Slides are in order, so the buckets are
+        # contiguous and their starts non-decreasing.
+        sizes = num_similar + num_dissimilar
+        stops = np.cumsum(sizes)
+        starts = stops - sizes
+
+        self.patches_directory = patches_directory
+        self.pairs_directory = pairs_directory
+        self.num_pairs = int(stops[-1]) if len(stops) > 0 else 0
+        self._bucket_starts = starts
+        self._bucket_stops = stops
+        self._bucket_num_similar = num_similar
+        self._bucket_slide_ids = np.array(slide_ids, dtype=str)
+
+        self._handles = HandleCache(_open_h5, self.MAX_OPEN_FILES)
+        # patches file -> its direct chunk layout (see _direct_chunk_layout)
+        self._patch_layouts = {}
+
+    @classmethod
+    def _count_pairs(cls, pairs_directory: Path, slide_ids):
+        """
+        Gets the number of similar and dissimilar pairs of every slide.
+
+        Reading the lengths means opening every pair file, so they are cached
+        in pairs_directory and reused while no pair file is newer than the cache.
+        An unreadable cache is ignored, and so is failing to write one (e.g. on
+        a read-only mount).
+        """
+        cache_file = pairs_directory / cls.BUCKET_CACHE
+        pair_files = [pairs_directory / (slide_id + ".h5") for slide_id in slide_ids]
+
+        try:
+            cache_mtime = os.path.getmtime(cache_file)
+            if all(os.path.getmtime(p) <= cache_mtime for p in pair_files):
+                with np.load(cache_file) as cache:
+                    if cache["slide_ids"].tolist() == slide_ids:
+                        return cache["num_similar"], cache["num_dissimilar"]
+        except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+            pass
 
-        for slide_id in slide_ids:
-            pairs_file = pairs_directory / (slide_id + ".h5")
-            start = num_pairs
+        num_similar = np.zeros(len(slide_ids), dtype=np.int64)
+        num_dissimilar = np.zeros(len(slide_ids), dtype=np.int64)
+        for i, pairs_file in enumerate(pair_files):
             with h5py.File(pairs_file, 'r') as f:
                 try:
-                    for label in ("similar", "dissimilar"):
-                        num_pairs += len(f[label])
+                    num_similar[i] = len(f["similar"])
+                    num_dissimilar[i] = len(f["dissimilar"])
                 except (KeyError, ValueError) as e:
                     print("Problem with ", pairs_file)
-            stop = num_pairs
-            buckets_to_slide[(start, stop)] = slide_id
-        
-        self.patches_directory = patches_directory
-        self.pairs_directory = pairs_directory
-        self.slide_ids = slide_ids
-        self.buckets_to_slide = buckets_to_slide
-        self.num_pairs = num_pairs
+
+        atomic_write(cache_file, lambda f: np.savez(
+            f,
+            slide_ids=np.array(slide_ids, dtype=str),
+            num_similar=num_similar,
+            num_dissimilar=num_dissimilar,
+        ))
+        return num_similar, num_dissimilar
+
+    @property
+    def slide_ids(self):
+        return self._bucket_slide_ids.tolist()
+
+    @property
+    def buckets_to_slide(self):
+        return dict(zip(
+            zip(self._bucket_starts.tolist(), self._bucket_stops.tolist()),
+            self.slide_ids,
+        ))
+
+    def close(self):
+        """Closes the HDF5 handles opened by this process."""
+        self._handles.close()
+
+    def _bucket_position(self, index):
+        # The bucket of an index is the last one starting at or before it
+        # (an empty bucket sorts before the one sharing its start)
+        return np.searchsorted(self._bucket_starts, index, side='right') - 1
 
     def get_bucket_from_index(self, index):
-        for (bmin, bmax) in self.buckets_to_slide.keys():
-            if index > bmin and index < bmax:
-                return (bmin, bmax)
+        position = self._bucket_position(index)
+        return int(self._bucket_starts[position]), int(self._bucket_stops[position])
 
     def __len__(self):
         return self.num_pairs
 
     def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor, str]:
-        bucket = self.get_bucket_from_index(index)
-        slide_id = self.buckets_to_slide[bucket]
+        position = self._bucket_position(index)
+        slide_id = str(self._bucket_slide_ids[position])
 
         indexes_file = self.pairs_directory / (slide_id + ".h5")
         patches_file = self.patches_directory / (slide_id + ".h5")
 
-        with h5py.File(indexes_file, 'r') as f:
-            start = bucket[0]
-            patch_index = index - start
-            if patch_index < len(f["similar"]):
-                label = "similar"
-                indices = f["similar"][patch_index]
-            else:
-                label = "dissimilar"
-                indices = f["dissimilar"][patch_index]
-        
-        with h5py.File(patches_file, 'r') as f:
-            p1, p2 = [f['imgs'][indices[i]] for i in range(2)]
+        f = self._handles.get(indexes_file)
+        patch_index = index - self._bucket_starts[position]
+        num_similar = self._bucket_num_similar[position]
+        if patch_index < num_similar:
+            label = "similar"
+            indices = f["similar"][patch_index]
+        else:
+            label = "dissimilar"
+            indices = f["dissimilar"][patch_index - num_similar]
+
+        imgs = self._handles.get(patches_file)['imgs']
+        # The layout is fixed per patch file, so it is only inspected once
+        if patches_file not in self._patch_layouts:
+            self._patch_layouts[patches_file] = self._direct_chunk_layout(imgs)
+        p1, p2 = self._read_patches(imgs, indices[:2], self._patch_layouts[patches_file])
 
         return torch.from_numpy(p1), torch.from_numpy(p2), label
+
+    @staticmethod
+    def _direct_chunk_layout(imgs: h5py.Dataset):
+        """
+        Returns (patch_shape, dtype) if every patch of the 'imgs' dataset is
+        stored in its own unfiltered chunk, else None.
+
+        CLAM stores patches that way, in which case the raw chunk bytes are the
+        patch and can be read directly, skipping HDF5's selection and filter
+        machinery.
+        """
+        patch_shape = imgs.shape[1:]
+        if imgs.chunks == (1,) + patch_shape and imgs.id.get_create_plist().get_nfilters() == 0:
+            return patch_shape, imgs.dtype
+        return None
+
+    @staticmethod
+    def _read_patches(imgs: h5py.Dataset, indices, layout) -> np.ndarray:
+        """
+        Reads the patches at indices from the 'imgs' dataset, given its layout
+        from _direct_chunk_layout.
+        """
+        if layout is not None:
+            patch_shape, dtype = layout
+            zeros = (0,) * len(patch_shape)
+            return np.stack([
+                np.frombuffer(imgs.id.read_direct_chunk((int(i),) + zeros)[1], dtype=dtype)
+                for i in indices
+            ]).reshape((len(indices),) + patch_shape)
+
+        # Otherwise read them in a single selection; h5py needs the indices
+        # increasing and unique, so read the sorted set and map back
+        unique_indices, order = np.unique(indices, return_inverse=True)
+        return imgs[unique_indices.tolist()][order]
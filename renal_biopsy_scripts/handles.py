@@ -0,0 +1,111 @@
+import os
+from collections import OrderedDict
+from contextlib import suppress
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Hashable, Union
+
+__all__ = ["HandleCache", "atomic_write"]
+
+
+def atomic_write(path: Union[Path, str], write: Callable[[BinaryIO], Any]) -> bool:
+    """
+    Writes path with write(f), never exposing a partially written file.
+
+    The data goes to a per-process temporary file next to path, which is then
+    moved into place, so concurrent readers see either the old file or the
+    complete new one.
+
+    Parameters
+    ----------
+    path: Union[Path, str]
+    write: Callable[[BinaryIO], Any]
+        Writes the contents to the binary file it is given
+
+    Returns
+    -------
+    written: bool
+        False if the file could not be written (e.g. on a read-only mount),
+        in which case nothing is left behind.
+    """
+    path = Path(path)
+    tmp_file = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_file, "wb") as f:
+            write(f)
+        os.replace(tmp_file, path)
+        return True
+    except OSError:
+        with suppress(OSError):
+            tmp_file.unlink()
+        return False
+
+
+class HandleCache:
+    """
+    Least recently used cache of open file handles.
+
+    Handles are cached per process: a forked DataLoader worker drops the
+    handles it inherited and lazily opens its own, and pickling (e.g. for
+    spawned workers) drops them too.
+
+    Parameters
+    ----------
+    opener: Callable
+        Opens a handle from a path. Has to be picklable (a module-level
+        function) for spawned workers.
+    maxsize: int
+        Number of handles kept open at once
+    close_evicted: bool
+        Close handles as they are evicted. Only safe if the handles are never
+        handed out to callers, who might still be using them; otherwise they
+        are closed when garbage collected.
+        Default=True
+    """
+
+    def __init__(
+        self, opener: Callable[[Any], Any], maxsize: int, close_evicted: bool = True
+    ):
+        self.opener = opener
+        self.maxsize = maxsize
+        self.close_evicted = close_evicted
+        self._handles = OrderedDict()
+        self._pid = None
+
+    def __getstate__(self):
+        # open handles can't be pickled
+        state = self.__dict__.copy()
+        state["_handles"] = OrderedDict()
+        state["_pid"] = None
+        return state
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def get(self, path: Hashable) -> Any:
+        """Returns the cached handle to path, opening it if needed."""
+        pid = os.getpid()
+        if self._pid != pid:
+            self._handles = OrderedDict()
+            self._pid = pid
+        if path in self._handles:
+            self._handles.move_to_end(path)
+            return self._handles[path]
+
+        handle = self.opener(path)
+        self._handles[path] = handle
+        if len(self._handles) > self.maxsize:
+            _, evicted = self._handles.popitem(last=False)
+            if self.close_evicted:
+                evicted.close()
+        return handle
+
+    def close(self):
+        """Closes the handles opened by this process."""
+        if getattr(self, "_pid", None) == os.getpid():
+            for handle in self._handles.values():
+                handle.close()
+        self._handles = OrderedDict()
@@ -1,10 +1,20 @@
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import typer
 
+def move(src: Path, dest: Path):
+    """Moves src to dest, copying across filesystems if it has to."""
+    try:
+        os.replace(src, dest)
+    except OSError:
+        shutil.move(str(src), str(dest))
+
 def main(
     patches_directory: Path,
     splits_directory: Path,
+    num_workers: int = 16,
 ):
     split_slides = {}
     folders = ("patches", "masks", "stitches")
@@ -21,8 +31,11 @@ def main(
         for folder in folders:
             os.makedirs(splits_directory / split / folder, exist_ok=True)
     
-    for slide_file in os.listdir(patches_dir):
-        slide_id = slide_file.split('.')[0]
+    with os.scandir(patches_dir) as entries:
+        slide_ids = [os.path.splitext(e.name)[0] for e in entries]
+
+    move_jobs = []
+    for slide_id in slide_ids:
         # NOTE: this condition is here because we have some slides
         # for which we have no data (i.e., there is no corresponding subject)
         if slide_id not in split_slides:
@@ -32,7 +45,11 @@ def main(
             fname = (slide_id + ext)
             src = patches_directory / folder / fname
             dest = splits_directory / split / folder / fname
-            os.rename(src, dest)
+            move_jobs.append((src, dest))
+
+    # Moves are syscall bound, so overlap them in threads
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(lambda job: move(*job), move_jobs))
 
 if __name__ == "__main__":
     # main(
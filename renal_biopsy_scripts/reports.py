@@ -88,14 +88,24 @@ class ReportsDataset(Dataset):
         print("Path: ", path)
         doc = Document(str(path))
 
-        def iter_tables(tables):
-            while len(tables) > 0:
-                table, tables = tables[0], tables[1:]
+        def iter_cells(tables):
+            for table in tables:
                 for row in table.rows:
-                    for cell in row.cells:
-                        yield from cell.paragraphs  # ["\n".join([p.text for p in cell.paragraphs])]
-                        yield from iter_tables(cell.tables)
-            return None
+                    yield from row.cells
+
+        def iter_tables(tables):
+            # Depth-first over nested tables in document order (the parsing
+            # below depends on it), with an explicit stack instead of recursion
+            stack = [iter_cells(tables)]
+            while stack:
+                cell = next(stack[-1], None)
+                if cell is None:
+                    stack.pop()
+                    continue
+                yield from cell.paragraphs  # ["\n".join([p.text for p in cell.paragraphs])]
+                nested_tables = cell.tables
+                if nested_tables:
+                    stack.append(iter_cells(nested_tables))
 
         i = 0
         d = Report(category, filepath.split(".")[0], filepath)
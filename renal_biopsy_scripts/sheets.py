@@ -6,15 +6,43 @@ By default this script saves the mapping between SP# and file names as a JSON.
 
 import sys
 import copy
-import math
 import json
+import hashlib
+import itertools
+import functools
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas
 from openpyxl import load_workbook, Workbook
+from openpyxl.utils.cell import coordinate_to_tuple
 from typing import Union, Dict, NamedTuple
 from pathlib import Path
-from pandas import DataFrame
-from collections import namedtuple
+from pandas import DataFrame, Series, to_numeric
 
-__all__ = ["get_tables", "get_subject_slides_mapping"]
+from handles import atomic_write
+
+__all__ = ["Tables", "get_tables", "get_subject_slides_mapping"]
+
+
+class Tables(NamedTuple):
+    """The parsed spreadsheets, one DataFrame per sheet."""
+
+    tcmr: DataFrame
+    abmr: DataFrame
+    tcmr_slides: DataFrame
+    abmr_slides: DataFrame
+    other: DataFrame
+
+
+CACHE_DIR = Path.home() / ".cache" / "clam_sheets"
+# The cache is shared by every environment of the user, so besides the parser
+# source it is keyed by what the pickles depend on
+_PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+_CACHE_DIGEST = hashlib.sha1(
+    Path(__file__).read_bytes()
+    + f"pandas={pandas.__version__};protocol={_PICKLE_PROTOCOL}".encode()
+).digest()
 
 def get_subject_slides_mapping(
     df: DataFrame,
@@ -50,26 +78,32 @@ def get_subject_slides_mapping(
         # at 2, to remove rows where there is no mapping
         df_filtered = df.dropna(thresh=2)
         assert df_filtered is not None and not df_filtered.empty
-        mapping = {}
-        for _, row in df_filtered.iterrows():
-            d = { "diagnosis": diagnosis }
-            for stain in stains:
-                num = float(str(row[stain]))
-                if math.isnan(num): continue
-                d[stain] = str(int(num))
-            mapping[row["SP#"]] = d
+        # Later rows for the same SP# replace earlier ones, but the SP# keeps
+        # the position of its first row (the keys are added before deduplicating)
+        mapping = {sp: { "diagnosis": diagnosis } for sp in df_filtered["SP#"]}
+        df_filtered = df_filtered.drop_duplicates("SP#", keep="last")
+        sp_numbers = df_filtered["SP#"]
+        # Slide numbers are stored as ints, floats or strings; convert each
+        # stain column at once and skip the missing ones
+        for stain in stains:
+            slides = to_numeric(df_filtered[stain], errors="coerce").dropna()
+            slides = slides.astype(np.int64).astype(str)
+            for sp, slide in zip(sp_numbers[slides.index], slides):
+                mapping[sp][stain] = slide
         return mapping
     else:
         stain="PAS"
-        mapping = {}
-        for _, row in df.iterrows():
-            d = { "diagnosis": diagnosis, stain: str(row["File Name"])}
-            mapping[row["SP#"]] = d
-        return mapping
+        file_names = df["File Name"].astype(str)
+        return {
+            sp: { "diagnosis": diagnosis, stain: file_name }
+            for sp, file_name in zip(df["SP#"], file_names)
+        }
 
 def get_tables(
-    rejection_path: Union[Path, str], other_path: Union[Path, str]
-) -> NamedTuple:
+    rejection_path: Union[Path, str],
+    other_path: Union[Path, str],
+    use_cache: bool = True,
+) -> Tables:
     """
     Gets spreadsheet data as Pandas DataFrames.
 
@@ -79,29 +113,274 @@ def get_tables(
         Path to 'Rejection & Infection Cases.xlsx'
     other_path: Union[Path, str]
         Path to 'Other Cases.xlsx'
+    use_cache: bool
+        Reuse the tables parsed from a workbook with the same contents by
+        the same version of this module and of pandas, cached in CACHE_DIR.
+        Default: True
 
     Returns
     -------
-    dataframes: NamedTuple
-        A tuple containing all data as pandas DataFrames.
+    dataframes: Tables
+        A tuple containing all data as pandas DataFrames. These are shared
+        between calls with the same workbooks and should not be modified.
     """
 
-    wb_rejection = load_workbook(rejection_path)
-    wb_other = load_workbook(other_path)
-
-    Tables = namedtuple(
-        "Tables", field_names=["tcmr", "abmr", "tcmr_slides", "abmr_slides", "other"]
+    # Repeated calls in one process reuse the parsed tables; the modification
+    # time is part of the key so an edited workbook is parsed again
+    rejection_path, other_path = Path(rejection_path).resolve(), Path(other_path).resolve()
+    return _get_tables(
+        str(rejection_path),
+        rejection_path.stat().st_mtime_ns,
+        str(other_path),
+        other_path.stat().st_mtime_ns,
+        use_cache,
     )
 
+
+@functools.lru_cache(maxsize=4)
+def _get_tables(
+    rejection_path: str,
+    rejection_mtime: int,
+    other_path: str,
+    other_mtime: int,
+    use_cache: bool,
+) -> Tables:
+    loaders = [
+        (rejection_path, _load_rejection_tables),
+        (other_path, _load_other_tables),
+    ]
+    cache_files = [_cache_file(path) if use_cache else None for path, _ in loaders]
+    tables = [_read_cached_tables(c) if c is not None else None for c in cache_files]
+
+    # The workbooks are independent and openpyxl parsing holds the GIL, so
+    # when both have to be parsed they are loaded in separate processes.
+    # A single workbook is parsed here; a pool would only add start-up cost.
+    to_parse = [i for i, t in enumerate(tables) if t is None]
+    if len(to_parse) > 1:
+        with ProcessPoolExecutor(max_workers=len(to_parse)) as executor:
+            futures = {i: executor.submit(loaders[i][1], loaders[i][0]) for i in to_parse}
+            for i, future in futures.items():
+                tables[i] = future.result()
+    else:
+        for i in to_parse:
+            tables[i] = loaders[i][1](loaders[i][0])
+    if use_cache:
+        for i in to_parse:
+            _write_cached_tables(cache_files[i], tables[i])
+
+    (tcmr, abmr, tcmr_slides, abmr_slides), (other,) = tables
     return Tables(
-        tcmr=parse_tcmr_sheet(wb_rejection["TCMR"]),
-        abmr=parse_abmr_sheet(wb_rejection["ABMR"]),
-        tcmr_slides=parse_slides_sheet(wb_rejection["TCMR Slides"]),
-        abmr_slides=parse_slides_sheet(wb_rejection["ABMR Slides"]),
-        other=parse_other_workbook(wb_other),
+        tcmr=tcmr,
+        abmr=abmr,
+        tcmr_slides=tcmr_slides,
+        abmr_slides=abmr_slides,
+        other=other,
     )
 
 
+def _load_workbook(path: Union[Path, str]) -> Workbook:
+    # Read-only mode streams rows instead of building every Cell up front.
+    # Formulas are kept (no data_only): the SP# parsing relies on their text.
+    wb = load_workbook(path, read_only=True, keep_links=False)
+    # Read-only sheets trust the <dimension> recorded in the file, which can
+    # be stale and would cut the sheet short; scan the actual rows instead
+    for sheet in wb.worksheets:
+        sheet.reset_dimensions()
+    return wb
+
+
+def _load_rejection_tables(rejection_path: Union[Path, str]):
+    wb = _load_workbook(rejection_path)
+    tables = (
+        parse_tcmr_sheet(wb["TCMR"]),
+        parse_abmr_sheet(wb["ABMR"]),
+        parse_slides_sheet(wb["TCMR Slides"]),
+        parse_slides_sheet(wb["ABMR Slides"]),
+    )
+    wb.close()
+    return tables
+
+
+def _load_other_tables(other_path: Union[Path, str]):
+    wb = _load_workbook(other_path)
+    tables = (parse_other_workbook(wb),)
+    wb.close()
+    return tables
+
+
+def _a1_range(top_left: str, bottom_right: str):
+    """
+    Converts an A1-style range to (min_row, min_col, max_row, max_col).
+    """
+    return coordinate_to_tuple(top_left) + coordinate_to_tuple(bottom_right)
+
+
+def _iter_range_values(sheet, bounds):
+    """
+    Iterates over the cell values of a range, row by row.
+
+    bounds is a range as returned by _a1_range. Unlike sheet[top_left:bottom_right]
+    this also works on read-only sheets. Those stop at the last row holding
+    data, so the range is padded with empty rows to its full height, as
+    sheet[top_left:bottom_right] returns it.
+    """
+    min_row, min_col, max_row, max_col = bounds
+    rows = sheet.iter_rows(
+        min_row=min_row,
+        max_row=max_row,
+        min_col=min_col,
+        max_col=max_col,
+        values_only=True,
+    )
+    empty_row = (None,) * (max_col - min_col + 1)
+    return itertools.islice(
+        itertools.chain(rows, itertools.repeat(empty_row)), max_row - min_row + 1
+    )
+
+
+def _cache_file(path: Union[Path, str]) -> Path:
+    # keyed by the workbook contents and by _CACHE_DIGEST, so an edited
+    # workbook, a change to the parsers or another pandas is parsed again
+    digest = hashlib.sha1(_CACHE_DIGEST)
+    with open(path, "rb") as f:
+        digest.update(f.read())
+    return CACHE_DIR / (digest.hexdigest() + ".pkl")
+
+
+def _read_cached_tables(cache_file: Path):
+    # a missing, truncated or otherwise unloadable cache is a miss
+    try:
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def _write_cached_tables(cache_file: Path, tables):
+    # failing to write just skips caching
+    atomic_write(
+        cache_file, lambda f: pickle.dump(tables, f, protocol=_PICKLE_PROTOCOL)
+    )
+
+
+def _normalize_sp_numbers(sp: Series) -> Series:
+    """
+    Normalizes an SP# column to 'SP-<number>' strings.
+
+    Cells holding a RIGHT(...) formula keep the number after the last quote,
+    and values without an 'SP' prefix get one.
+    """
+    sp = sp.astype(str)
+    formula = sp.str.contains("RIGHT(", regex=False)
+    numbers = sp[formula].str.split("\"").str[-1].map(int).astype(str)
+    sp[formula] = "SP-" + numbers
+    missing_prefix = ~sp.str.contains("SP", regex=False)
+    sp[missing_prefix] = "SP-" + sp[missing_prefix]
+    return sp
+
+
+def _empty(vals):
+    return ""
+
+
+def _merge_sp(vals, pre, post):
+    return f"{vals[pre]}{vals[post]}"
+
+
+def _merge_abmr_secondary_dx(vals, pre, post):
+    return f"{vals[pre]} {vals[post]}"
+
+
+def _merge_abmr_time_post_tx(vals, pre, post):
+    return f"{vals[pre]} {str(vals[post]).lower()}"
+
+
+def _merge_tcmr_time_post_tx(vals, num, units):
+    return f"{vals[num]} {vals[units].lower()}"
+
+
+# Dictionaries with mapped behaviour for missing or weird columns.
+# This keeps the main loops short and all of the adjustments that have to be
+# made in one single place. Each dealer comes with the sheet columns its
+# arguments refer to, which _row_recipe turns into positions.
+_ABMR_DEALERS = {
+    "SP#": (_merge_sp, {"pre": "SP# pre", "post": "SP# post"}),
+    "Secondary Dx": (
+        _merge_abmr_secondary_dx,
+        {"pre": "Secondary Dx pre", "post": "Secondary Dx post"},
+    ),
+    "Time Post-Tx": (
+        _merge_abmr_time_post_tx,
+        {"pre": "Time Post-Tx pre", "post": "Time Post-Tx post"},
+    ),
+    "Unnamed_col": (_empty, {}),
+}
+
+_TCMR_DEALERS = {
+    #########################
+    # Merge columns
+    #########################
+    # TODO: is the SP- prefix needed?
+    "SP#": (_merge_sp, {"pre": "SP# prefix", "post": "SP# postfix"}),
+    "Time Post-Tx": (
+        _merge_tcmr_time_post_tx,
+        {"num": "Time Post-Tx num", "units": "Time Post-Tx units"},
+    ),
+    #########################
+    # All columns missing from earlier years
+    #########################
+    "Acute TCMR": (_empty, {}),
+    "MD": (_empty, {}),
+    #########################
+    # All columns missing from the more recent years
+    #########################
+    "Clinical Hx": (_empty, {}),
+    "Cr (baseline)": (_empty, {}),
+    "Cr (current)": (_empty, {}),
+    "Proteinuria": (_empty, {}),
+    "Specimen Type": (_empty, {}),
+}
+
+
+def _row_recipe(columns, table_columns, dealers):
+    """
+    Resolves each output column to its index in the sheet columns, or to the
+    dealer that builds it, so the row loop does no per-cell name lookups.
+
+    Dealers get the positions of their source columns in this layout bound
+    up front; they are then called with the row values only.
+    """
+    idx = {k: i for i, k in enumerate(columns)}
+    recipe = []
+    for k in table_columns:
+        if k in idx:
+            recipe.append((k, idx[k], None))
+        else:
+            fn, sources = dealers[k]
+            positions = {arg: idx[col] for arg, col in sources.items()}
+            recipe.append((k, None, functools.partial(fn, **positions)))
+    return recipe
+
+
+# Where the data sits in each sheet, resolved to numeric bounds once
+_OTHER_RANGE = _a1_range("A2", "Y186")  # TODO: what to do about the missing columns?
+
+# The ABMR and TCMR sheets hold one block per year, most recent first
+_ABMR_YEAR_RANGES = {
+    "2020": _a1_range("A3", "AN16"),
+    "2019": _a1_range("A20", "AM36"),
+    "2018": _a1_range("A40", "AM46"),
+}
+
+_TCMR_YEAR_RANGES = {
+    "2020": _a1_range("A3", "N11"),
+    "2019": _a1_range("A15", "N29"),
+    "2018": _a1_range("A33", "N47"),
+    "2017": _a1_range("A52", "P73"),
+    "2016": _a1_range("A78", "P83"),
+}
+
+
 def parse_other_workbook(wb: Workbook):
     sheet = wb["Sheet1"]
 
@@ -133,31 +412,23 @@ def parse_other_workbook(wb: Workbook):
         "Race",
     ]
 
-    top_left, bottom_right = "A2", "Y186"  # TODO: what to do about the missing columns?
-
     # # TODO : parse date using this module
     # deal_with_it = {
     #     "DOB": lambda x: datetime.strptime(x, "")
     # }
 
-    table = []
-    for sheet_row in sheet[top_left:bottom_right]:
-        d = {k: (v.value if v.value else "") for k, v in zip(columns, sheet_row)}
-        table.append(d)
+    # Drop the EMPTY spacer columns up front and build the frame in one go
+    keep = [i for i, k in enumerate(columns) if k != "EMPTY"]
+    table = [
+        tuple((sheet_row[i] if sheet_row[i] else "") for i in keep)
+        for sheet_row in _iter_range_values(sheet, _OTHER_RANGE)
+    ]
 
-    df = DataFrame.from_dict(table)
-    del df["EMPTY"]
-    return df
+    return DataFrame(table, columns=[columns[i] for i in keep])
 
 
 def parse_slides_sheet(sheet):
-    columns = [
-        "SP# pre",
-        "SP# post",
-        "H&E",
-        "PAS",
-        "Trichrome",
-    ]
+    # The sheet columns are: SP# pre, SP# post, H&E, PAS, Trichrome
     table_columns = [
         "SP#",
         "H&E",
@@ -165,19 +436,13 @@ def parse_slides_sheet(sheet):
         "Trichrome",
     ]
 
-    deal_with_it = {
-        "SP#": lambda d: "".join((d["SP# pre"], str(d["SP# post"]))),
-    }
-
     table = []
-    for row in sheet.iter_rows(min_row=2, max_col=5):
-        if row[0].value is None:
+    for row in sheet.iter_rows(min_row=2, max_col=5, values_only=True):
+        if row[0] is None:
             break
-        d = {k: v.value for k, v in zip(columns, row)}
-        table_row = {k: d[k] if k in d else deal_with_it[k](d) for k in table_columns}
-        table.append(table_row)
+        table.append(("".join((row[0], str(row[1]))), row[2], row[3], row[4]))
 
-    return DataFrame(table)
+    return DataFrame(table, columns=table_columns)
 
 
 def parse_abmr_sheet(sheet):
@@ -303,46 +568,24 @@ def parse_abmr_sheet(sheet):
         "t-IFTA",
     ]
 
-    years = ["2020", "2019", "2018"]
-    year_positions = {
-        "2020": ("A3", "AN16"),
-        "2019": ("A20", "AM36"),
-        "2018": ("A40", "AM46"),
-    }
-
-    deal_with_it = {
-        "SP#": lambda d: "".join((d["SP# pre"], str(d["SP# post"]))),
-        "Secondary Dx": lambda d:  " ".join(
-            (d["Secondary Dx pre"], str(d["Secondary Dx post"]))),
-        "Time Post-Tx": lambda d: " ".join(
-            (str(d["Time Post-Tx pre"]), str(d["Time Post-Tx post"]).lower())
-        ),
-        "Unnamed_col": lambda _: "",
-    }
-
-    table = []
-    for year in years:
-        top_left, bottom_right = year_positions[year]
+    # Built column by column: one list per output column
+    table = {k: [] for k in table_columns}
+    table["Year"] = []
+    for year, bounds in _ABMR_YEAR_RANGES.items():
         columns = columns_2020 if year == "2020" else columns_2019_2018
-        for sheet_row in sheet[top_left:bottom_right]:
-            d = {k: (v.value if v.value else "") for k, v in zip(columns, sheet_row)}
-            table_row = {
-                k: d[k] if k in d else deal_with_it[k](d) for k in table_columns
-            }
-            table_row["Year"] = year
-            if "RIGHT(" in str(table_row["SP#"]):
-                spnum = int(str(table_row["SP#"].split("\"")[-1]))
-                table_row["SP#"] = "SP-"+str(spnum)
-            if "SP" not in str(table_row["SP#"]):
-                table_row["SP#"] = "SP-"+str(table_row["SP#"])
-            table_row["Year"] = year
-            table.append(table_row)
-
-    return DataFrame(table)
+        recipe = _row_recipe(columns, table_columns, _ABMR_DEALERS)
+        for sheet_row in _iter_range_values(sheet, bounds):
+            vals = [v if v else "" for v in sheet_row]
+            for k, i, fn in recipe:
+                table[k].append(vals[i] if fn is None else fn(vals))
+            table["Year"].append(year)
+
+    df = DataFrame(table)
+    df["SP#"] = _normalize_sp_numbers(df["SP#"])
+    return df
 
 
 def parse_tcmr_sheet(sheet):
-    years = ["2020", "2019", "2018", "2017", "2016"]
     cols_2020_2018 = [
         "Status",
         "Pending",
@@ -395,68 +638,31 @@ def parse_tcmr_sheet(sheet):
         "Status",
         "Time Post-Tx",
     ]
-    year_positions = {
-        "2020": ("A3", "N11"),
-        "2019": ("A15", "N29"),
-        "2018": ("A33", "N47"),
-        "2017": ("A52", "P73"),
-        "2016": ("A78", "P83"),
-    }
-
-    # Dictionary with mapped behaviour for missing or weird columns.
-    # This keeps the main loop short and all of the adjustments that have to be
-    # made in one single place.
-    deal_with_it = {
-        #########################
-        # Merge columns
-        #########################
-        "SP#": lambda d: "".join(
-            [d["SP# prefix"], str(d["SP# postfix"])]
-        ),  # TODO: is the SP- prefix needed?
-        "Time Post-Tx": lambda d: " ".join(
-            [str(i) for i in (d["Time Post-Tx num"], d["Time Post-Tx units"].lower())]
-        ),
-        #########################
-        # All columns missing from earlier years
-        #########################
-        "Acute TCMR": lambda _: "",
-        "MD": lambda _: "",
-        #########################
-        # All columns missing from the more recent years
-        #########################
-        "Clinical Hx": lambda _: "",
-        "Cr (baseline)": lambda _: "",
-        "Cr (current)": lambda _: "",
-        "Proteinuria": lambda _: "",
-        "Specimen Type": lambda _: "",
-    }
-    table = []
-    for year in years:
-        top_left, bottom_right = year_positions[year]
+
+    # Built column by column: one list per output column
+    table = {k: [] for k in all_unique_cols}
+    table["Year"] = []
+    for year, bounds in _TCMR_YEAR_RANGES.items():
         columns = cols_2020_2018 if year[-1] in "098" else cols_2017_2016
-        for sheet_row in sheet[top_left:bottom_right]:
-            d = {k: (v.value if v.value else "") for k, v in zip(columns, sheet_row)}
-            table_row = {
-                k: d[k] if k in d else deal_with_it[k](d) for k in all_unique_cols
-            }
-            if "RIGHT(" in str(table_row["SP#"]):
-                spnum = int(str(table_row["SP#"].split("\"")[-1]))
-                table_row["SP#"] = "SP-"+str(spnum)
-
-            if "SP" not in str(table_row["SP#"]):
-                table_row["SP#"] = "SP-"+str(table_row["SP#"])
-            table_row["Year"] = year
-            table.append(table_row)
-    return DataFrame(table)
+        recipe = _row_recipe(columns, all_unique_cols, _TCMR_DEALERS)
+        for sheet_row in _iter_range_values(sheet, bounds):
+            vals = [v if v else "" for v in sheet_row]
+            for k, i, fn in recipe:
+                table[k].append(vals[i] if fn is None else fn(vals))
+            table["Year"].append(year)
+
+    df = DataFrame(table)
+    df["SP#"] = _normalize_sp_numbers(df["SP#"])
+    return df
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print(f"Usage: {sys.argv[0]} <path_to_rejection_cases> <path_to_other_cases>")
+    args = [a for a in sys.argv[1:] if a != "--no-cache"]
+    if len(args) != 2:
+        print(f"Usage: {sys.argv[0]} [--no-cache] <path_to_rejection_cases> <path_to_other_cases>")
         exit(0)
-    rejection_path = sys.argv[1]
-    other_path = sys.argv[2]
-    tables = get_tables(rejection_path, other_path)
+    rejection_path, other_path = args
+    tables = get_tables(rejection_path, other_path, use_cache="--no-cache" not in sys.argv)
     tcmr_slides, abmr_slides, non_rejection_slides = [tables[i+2] for i in range(3)]
     tcmr_map, abmr_map, nr_map = (get_subject_slides_mapping(tcmr_slides, "tcmr"),
                                   get_subject_slides_mapping(abmr_slides, "abmr"),
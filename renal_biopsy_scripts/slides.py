@@ -3,14 +3,38 @@ import os
 import openslide
 import torch
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from torch.utils.data import Dataset
-from typing import Union, Callable, Optional, Dict, Any
+from typing import Union, Callable, Optional, Dict, Any, Tuple
 from pathlib import Path
 from statistics import mode, median
 
+from handles import HandleCache
+
 __all__ = ["SlidesDataset"]
 
 
+def _open_slide(path: Path) -> openslide.OpenSlide:
+    return openslide.OpenSlide(str(path))
+
+
+def _probe_slide(
+    path: Path, thumbnail_dir: Optional[Path] = None
+) -> Tuple[int, Tuple[int, int]]:
+    """
+    Reads the level count and dimensions of a slide, optionally saving its thumbnail.
+    """
+    s = openslide.OpenSlide(str(path))
+    try:
+        if thumbnail_dir is not None:
+            s.associated_images["thumbnail"].save(
+                str(thumbnail_dir / (path.stem + ".png"))
+            )
+        return s.level_count, s.dimensions
+    finally:
+        s.close()
+
+
 class SlidesDataset(Dataset):
     """
     Slides Dataset.
@@ -20,37 +44,54 @@ class SlidesDataset(Dataset):
     root_dir: Union[Path, str]
     transform: Optional[Callable]
         Default=None
+
+    Notes
+    -----
+    Slides are opened once and the handles are shared between lookups, so
+    neither callers nor transforms should close the slides they are given.
+    Call close() to release them.
     """
 
     ALLOWED_EXTENSIONS = ["svs"]
+    MAX_OPEN_SLIDES = 128
 
     def __init__(
         self, root_dir: Union[Path, str], transform: Optional[Callable] = None
     ):
         self.transform = transform
-        self.im_paths = {
-            i.split(".")[0]: Path(root_dir) / i
-            for i in os.listdir(str(root_dir))
-            if i.split(".")[1] in self.ALLOWED_EXTENSIONS
-        }
+        self.im_paths = {}
+        with os.scandir(str(root_dir)) as entries:
+            for entry in entries:
+                slide_id, ext = os.path.splitext(entry.name)
+                if ext[1:] in self.ALLOWED_EXTENSIONS:
+                    self.im_paths[slide_id] = Path(entry.path)
         self.paths = list(self.im_paths.values())
         self.summary_stats = None
+        # Slides are handed out, so evicted ones are left to be closed when
+        # they are garbage collected rather than closed under the caller
+        self._handles = HandleCache(
+            _open_slide, self.MAX_OPEN_SLIDES, close_evicted=False
+        )
+
+    def close(self):
+        """Closes the slides opened by this process."""
+        self._handles.close()
 
     def __len__(self):
         return len(self.im_paths)
 
     def __getitem__(
         self, query: Union[int, str]
-    ) -> Union[opesnlide.OpenSlide, torch.Tensor]:
+    ) -> Union[openslide.OpenSlide, torch.Tensor]:
         """
         Overload getitem to allow accessing slides by id
         """
         if isinstance(query, str):
             if query not in self.im_paths:
                 raise KeyError(f"Slide id {query} not found")
-            slide = openslide.OpenSlide(str(self.im_paths[query]))
+            slide = self._handles.get(self.im_paths[query])
         else:
-            slide = openslide.OpenSlide(str(self.paths[query]))
+            slide = self._handles.get(self.paths[query])
         if self.transform is not None:
             slide = self.transform(slide)
         return slide
@@ -68,22 +109,24 @@ class SlidesDataset(Dataset):
             If provided, it will save thumbnail image of each slide to this directory.
             Default=None
         """
-        levels = []
-        dimensions = []
         if not self.summary_stats:
-            for s in tqdm(self):
-                levels.append(s.level_count)
-                dimensions.append(s.dimensions)
-                if save_thumbnail_images:
-                    if not os.path.exists(str(save_thumbnail_images)):
-                        os.mkdir(str(save_thumbnail_images))
-                    s.associated_images["thumbnail"].save(
-                        str(
-                            Path(save_thumbnail_images)
-                            / s._filename.split("/")[-1].split(".")[0]
-                        )
-                        + ".png"
-                    )
+            thumbnail_dir = None
+            if save_thumbnail_images:
+                thumbnail_dir = Path(save_thumbnail_images)
+                thumbnail_dir.mkdir(parents=True, exist_ok=True)
+
+            # Opening a slide is I/O and libopenslide bound (the GIL is
+            # released), so probe the slides from a thread pool
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                probes = list(tqdm(
+                    executor.map(
+                        lambda path: _probe_slide(path, thumbnail_dir),
+                        self.paths,
+                    ),
+                    total=len(self.paths),
+                ))
+            levels, dimensions = zip(*probes)
+            widths, heights = zip(*dimensions)
 
             self.summary_stats = {
                 "num_levels": {
@@ -92,12 +135,12 @@ class SlidesDataset(Dataset):
                     "max": max(levels),
                 },
                 "dimensions": {
-                    "min_w": min([m[0] for m in dimensions]),
-                    "max_w": max([m[0] for m in dimensions]),
-                    "median_w": median([m[0] for m in dimensions]),
-                    "min_h": min([m[1] for m in dimensions]),
-                    "max_h": max([m[1] for m in dimensions]),
-                    "median_h": median([m[1] for m in dimensions]),
+                    "min_w": min(widths),
+                    "max_w": max(widths),
+                    "median_w": median(widths),
+                    "min_h": min(heights),
+                    "max_h": max(heights),
+                    "median_h": median(heights),
                 },
             }
         return self.summary_stats
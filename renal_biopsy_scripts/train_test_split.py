@@ -1,8 +1,7 @@
-import math
 import os
 import random
 from pathlib import Path
-from typing import Dict, List, Union, Tuple
+from typing import Dict, List, Optional, Set, Union, Tuple
 
 import numpy as np
 import pandas as pd
@@ -27,11 +26,9 @@ def write_list_to_file(filename: Path, li: List[str]):
     filename : Path
     li : List[str]
     """
-    with open(filename, "w") as f:
-        for i in li:
-            f.write(f"{i}\n")
+    Path(filename).write_text("".join(f"{i}\n" for i in li))
 
-def main(root: Path, output_dir: Path, test_pct: float=.25, random_seed: int=42):
+def main(root: Path, output_dir: Path, test_pct: float=.25, random_seed: int=42, cache: bool=True):
     """Splits the data into training and test data.
 
     This script will create the following files and directories:
@@ -56,12 +53,16 @@ def main(root: Path, output_dir: Path, test_pct: float=.25, random_seed: int=42)
         Amount of data to store in test, by default .25
     random_seed : int, optional
         by default 42
+    cache : bool, optional
+        Reuse previously parsed spreadsheets (see sheets.get_tables), by default True
     """
     random.seed(random_seed)
     np.random.seed(random_seed)
-    mapping, all_slides = get_mapping_and_slides(root)
+    mapping, all_slides = get_mapping_and_slides(root, use_cache=cache)
     df = get_diagnosis_df(mapping, all_slides)
-    df_train, df_test = split_df_by_group(df, group="diagnosis", test_pct=test_pct)
+    df_train, df_test = split_df_by_group(
+        df, group="diagnosis", test_pct=test_pct, random_seed=random_seed
+    )
 
     for split, df_split in zip(("train", "test"), (df_train, df_test)):
         split_dir = output_dir/split
@@ -78,50 +79,62 @@ def main(root: Path, output_dir: Path, test_pct: float=.25, random_seed: int=42)
 
         df_split.to_csv(split_dir/"data.csv", index=False)
 
-def get_mapping_and_slides(root) -> Tuple[Mapping, List[str]]:
+def get_mapping_and_slides(root, use_cache: bool = True) -> Tuple[Mapping, Set[str]]:
     dirs = get_multimodal_renal_dataset_directories(root)
 
-    all_slides = []
-    for slide_folder in dirs["slides_folders"]:
-        all_slides.extend([i.split('.')[0] for i in os.listdir(slide_folder)])
+    # only slide files can end up in the dataset (their ids get SLIDE_EXT)
+    all_slides = {
+        p.stem
+        for slide_folder in dirs["slides_folders"]
+        for p in Path(slide_folder).glob("*" + SLIDE_EXT)
+    }
 
     # the first two tables do not contain any slide info
     # nr=no rejection
-    _, _, tcmr_slides, abmr_slides, nr_slides = get_tables(dirs["rejection_path"], dirs["other_path"])
+    _, _, tcmr_slides, abmr_slides, nr_slides = get_tables(
+        dirs["rejection_path"], dirs["other_path"], use_cache=use_cache
+    )
     tcmr_map, abmr_map, nr_map = (get_subject_slides_mapping(tcmr_slides, "tcmr"),
                                 get_subject_slides_mapping(abmr_slides, "abmr"),
                                 get_subject_slides_mapping(nr_slides, "other"))
     mapping = {**tcmr_map, **abmr_map, **nr_map}
     return mapping, all_slides
 
-def get_diagnosis_df(mapping: Mapping, all_slides: List[str]) ->pd.DataFrame:
-    slide_rows = []
-    for accession, params in mapping.items():
-        for stain in STAINS:
-            if stain not in params:
-                continue
-            if params[stain] in all_slides:
-                slide_rows.append({
-                    CLAM_PATIENT_ID: accession,
-                    CLAM_SLIDE_ID: params[stain]+SLIDE_EXT,
-                    "diagnosis": params["diagnosis"]
-                })
-    df = pd.DataFrame(slide_rows)
+def get_diagnosis_df(mapping: Mapping, all_slides: Set[str]) ->pd.DataFrame:
+    subjects = pd.DataFrame.from_dict(mapping, orient="index").reindex(
+        columns=["diagnosis", *STAINS]
+    )
+    # One entry per (subject, stain) with a known slide, ordered by subject and
+    # then stain; missing stains never match all_slides
+    slides = subjects[list(STAINS)].stack()
+    # slides is all-NaN float when no subject has a slide; keep it as strings
+    slides = slides[slides.isin(all_slides)].astype(object)
+    case_ids = slides.index.get_level_values(0)
+    df = pd.DataFrame({
+        CLAM_PATIENT_ID: case_ids,
+        CLAM_SLIDE_ID: (slides + SLIDE_EXT).values,
+        "diagnosis": subjects["diagnosis"].reindex(case_ids).values,
+    })
     return df
 
-def split_df_by_group(df: pd.DataFrame, group: str, test_pct: float) -> Tuple[pd.DataFrame, pd.DataFrame]: 
-    subjects_by_group = df.groupby(group)[CLAM_PATIENT_ID].apply(lambda x: np.unique(x))
-    train_subjects, test_subjects = [], []
-    groups = subjects_by_group.index.tolist()
-    for group in groups:
-        subjects_group = (subjects_by_group[group])
-        np.random.shuffle(subjects_group)
-        test_amount = math.ceil(len(subjects_group) * test_pct)
-        test_subjects.extend(subjects_group[:test_amount])
-        train_subjects.extend(subjects_group[test_amount:])
-
-    df_train = df[df[CLAM_PATIENT_ID].isin(train_subjects)]
-    df_test = df[df[CLAM_PATIENT_ID].isin(test_subjects)]
+def split_df_by_group(
+    df: pd.DataFrame, group: str, test_pct: float, random_seed: Optional[int] = None
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    # Shuffle the unique subjects once, then send the first ceil(n * test_pct)
+    # subjects of every group to test
+    subjects = df[[group, CLAM_PATIENT_ID]].drop_duplicates()
+    subjects = subjects.sample(frac=1, random_state=random_seed)
+    by_group = subjects.groupby(group)[CLAM_PATIENT_ID]
+    rank = by_group.cumcount()
+    test_amount = np.ceil(by_group.transform("size") * test_pct).astype(int)
+    test_mask = rank < test_amount
+    test_subjects = pd.Index(subjects.loc[test_mask, CLAM_PATIENT_ID])
+
+    # every subject is in exactly one split, so a single membership pass
+    # partitions the rows
+    is_test = df[CLAM_PATIENT_ID].isin(test_subjects)
+    df_train = df[~is_test]
+    df_test = df[is_test]
 
     return df_train, df_test
 